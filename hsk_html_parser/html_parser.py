@@ -3,12 +3,16 @@ Custom HTMLParser class for extracting HSK words and translating them to French
 """
 
 import ast
+import contextlib
+import functools
+import json
 import logging
+import mmap
+import os
+import pickle
 import re
-import xml.etree.ElementTree as ET
 from html.parser import HTMLParser
-
-import pandas as pd
+from xml.sax.saxutils import escape
 
 logging.basicConfig(
     encoding="utf-8",
@@ -35,61 +39,166 @@ Placement of the pinyin tone mark
 | ü-  |   (üà)  | üè  |     |     |     |
 """
 
+# A dictionary for corresponding pinyins
+# to their accents, e.g. i3 -> ǐ
+_PINYIN_TONE = {
+    "a": "a\u0101\u00e1\u01ce\u00e0a",
+    "e": "e\u0113\u00e9\u011b\u00e8e",
+    "i": "i\u012b\u00ed\u01d0\u00eci",
+    "o": "o\u014d\u00f3\u01d2\u00f2o",
+    "u": "u\u016b\u00fa\u01d4\u00f9u",
+    "\u00fc": "\u00fc\u01d6\u01d8\u01da\u01dc\u00fc",
+}  # accent 5 corresponds to no accent at all
+
+# The same table flattened to (vowel, tone) keys, so that looking up an
+# accented vowel is a single dict probe without slicing the accent string
+_TONE = {
+    (vowel, tone): accents[tone]
+    for vowel, accents in _PINYIN_TONE.items()
+    for tone in range(6)
+}
+
+_VOWELS_RE = re.compile(r"[aeiou\u00fc]+")  # find all vowels
+
+# Destructures one .u8 line ('Traditionnel Simplifi\u00e9 [pin1 yin1] /trad 1/trad 2/')
+# into its simplified, pinyin and translations groups in a single scan.
+# [^ ]+ rather than \S+ because a few entries contain tabs or ideographic
+# spaces inside the words themselves. A bytes pattern anchored at line
+# starts, so the whole memory-mapped file can be scanned in one finditer
+# call without materializing a str per line; . never crosses a newline
+# but does absorb the \r of the file's \r\n endings, which the trailing /
+# leaves out of the translations group
+_U8_LINE_RE = re.compile(rb"(?m)^[^ \n]+ (.*?) \[([^]\n]+)\] /(.*)/")
+
+# Part of the pickle cache key of ChineseToFrenchDictionary. Bump it
+# whenever process_u8_dictionary's output changes, so that caches written
+# by older code are rebuilt instead of served under the new parsing
+_DICT_CACHE_VERSION = 2
+
+# Folds the lowercasing and the v --> ü substitution into one
+# str.translate pass over the particle. "u:" spans two characters and
+# cannot go in the table, so it keeps its own (rare) str.replace below
+_PINYIN_TRANS = str.maketrans(
+    "ABCDEFGHIJKLMNOPQRSTUVWXYZv", "abcdefghijklmnopqrstu\u00fcwxyz\u00fc"
+)
+
+
+@functools.lru_cache(maxsize=4096)
+def _accent_syllable(raw):
+    """
+    Converts a single numeral pinyin particle to its accented form.
+    For instance 'shou3' --> 'shǒu'
+    Mandarin only has ~1600 distinct toned syllables, so the result is
+    memoized: repeated particles across the .u8 file cost a cache probe.
+
+    Positionnal arguments:
+    raw (str) -- A particle matched by ChineseToFrenchDictionary.pinyin_re
+    Returns a str object, with the correct pinyin
+    """
+    pinyin_correct = raw.translate(_PINYIN_TRANS)
+    if ":" in pinyin_correct:
+        pinyin_correct = pinyin_correct.replace("u:", "\u00fc")
+
+    vowels = _VOWELS_RE.search(pinyin_correct)
+    # Check which letter to put accent on
+    if (len(vowels.group()) == 1) or vowels.group()[0] in "aeo":
+        position = vowels.start()
+    else:
+        position = vowels.start() + 1
+    # ord() - 48 converts the trailing ASCII digit without an int() call
+    accented = _TONE[(pinyin_correct[position], ord(pinyin_correct[-1]) - 48)]
+    # The vowel position is known, so splice by index instead of
+    # rescanning the particle with str.replace
+    return (
+        pinyin_correct[:position] + accented + pinyin_correct[position + 1 : -1]
+    )  # We do not take the last number
+
 
 class ChineseToFrenchDictionary:
     """
     Class for creating a Chinese --> French dictionary
-    # as a dataframe
+    # as a dict keyed by the simplified form
     """
 
-    def __init__(self, u8_file=None):
-        # A dictionary for corresponding pinyins
-        # to their accents, e.g. i3 -> ǐ
-        self.pinyin_tone = {
-            "a": "a\u0101\u00e1\u01ce\u00e0a",
-            "e": "e\u0113\u00e9\u011b\u00e8e",
-            "i": "i\u012b\u00ed\u01d0\u00eci",
-            "o": "o\u014d\u00f3\u01d2\u00f2o",
-            "u": "u\u016b\u00fa\u01d4\u00f9u",
-            "\u00fc": "\u00fc\u01d6\u01d8\u01da\u01dc\u00fc",
-        }  # accent 5 corresponds to no accent at all
+    def __init__(self, u8_file=None, use_cache=True):
+        self.pinyin_tone = _PINYIN_TONE
 
         # Regular expressions used to find pinyins
         # and vowels with accent in words
         self.pinyin_re = re.compile(r"[a-zA-Z:]+\d")
-        self.vowels_re = re.compile(r"[aeiou\u00fc]+")  # find all vowels
+        self.vowels_re = _VOWELS_RE
 
-        # Puts the dictionary data in a DataFrame
+        # Puts the dictionary data in a dict
         if u8_file:
-            self.df = self.process_u8_dictionary(u8_file)
+            if use_cache:
+                self.by_simplified = self._load_or_build_cache(u8_file)
+            else:
+                self.by_simplified = self.process_u8_dictionary(u8_file)
+
+    def _load_or_build_cache(self, u8_file):
+        """
+        Loads the processed dictionary from a pickle cache stored next to
+        the .u8 file, rebuilding and re-caching it whenever the .u8 file's
+        size or modification time changes, or when _DICT_CACHE_VERSION is
+        bumped. Repeat runs skip the parsing and accent conversion
+        entirely.
+
+        Positionnal arguments:
+        u8_file (str) -- The path to the u8_file containing the original dictionary.
+        Returns a dict, as process_u8_dictionary
+        """
+        cache_file = u8_file + ".cache.pkl"
+        stat = os.stat(u8_file)
+        cache_key = (_DICT_CACHE_VERSION, stat.st_mtime_ns, stat.st_size)
+        try:
+            with open(cache_file, "rb") as file:
+                cached_key, by_simplified = pickle.load(file)
+            if cached_key == cache_key:
+                return by_simplified
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+            pass  # No cache yet, or an unreadable one: rebuild it
+
+        by_simplified = self.process_u8_dictionary(u8_file)
+        try:
+            with open(cache_file, "wb") as file:
+                pickle.dump(
+                    (cache_key, by_simplified), file, protocol=pickle.HIGHEST_PROTOCOL
+                )
+        except OSError:
+            logger.warning("Could not write the dictionary cache %s", cache_file)
+        return by_simplified
 
     def process_u8_dictionary(self, u8_file):
         """
-        Creates a dataframe serving as a Chinese->French dictionary
-           Simplified 	Pinyin 	      Translation
-        0     精美 	  jīng měi 	élégant ; exquis ; délicat ; gracieux ; délici...
-        1     亲近 	  qīn jìn 	proche ; intime
-        2     修改 	  xiū gǎi 	réviser ; modifier ; éditer
+        Creates a dict serving as a Chinese->French dictionary, mapping each
+        simplified word to its translations keyed by pinyin, e.g.
+        {"精美": {"jīng měi": "élégant ; exquis ; délicat ; gracieux ..."},
+         "亲近": {"qīn jìn": "proche ; intime"},
+         "修改": {"xiū gǎi": "réviser ; modifier ; éditer"}}
 
         Positionnal arguments:
         u8_file (str) -- The path to the u8_file containing the original dictionary.
-        Returns a pandas.DataFrame
-        """
-
-        with open(u8_file, encoding="utf-8") as file:
-            lines = [k[:-2] for k in file.readlines() if k[0] != "#"]
-
-        lines_data = [
-            [
-                l.split(" ")[1].strip(),
-                self.format_pinyin(l.split("[")[1].split("]")[0]).strip(),
-                " ; ".join(l.split("/")[1:]),
-            ]
-            for l in lines
-        ]
-        return pd.DataFrame(
-            columns=["Simplified", "Pinyin", "Translation"], data=lines_data
-        )
+        Returns a dict
+        """
+
+        by_simplified = {}
+        # Bound methods looked up once instead of once per line
+        setdefault = by_simplified.setdefault
+        format_pinyin = self.format_pinyin
+        # The file is memory-mapped and scanned in place: lines that do
+        # not match (typically the '#' header lines) are skipped without
+        # ever being decoded, and matching lines are decoded group by
+        # group instead of allocating a str per line
+        with open(u8_file, "rb") as file, mmap.mmap(
+            file.fileno(), 0, access=mmap.ACCESS_READ
+        ) as mapped:
+            for match in _U8_LINE_RE.finditer(mapped):
+                simplified, pinyin, translations = match.groups()
+                translation = " ; ".join(translations.decode("utf-8").split("/"))
+                setdefault(simplified.decode("utf-8").strip(), {})[
+                    format_pinyin(pinyin.decode("utf-8")).strip()
+                ] = translation
+        return by_simplified
 
     def format_pinyin(self, pinyins):
         """
@@ -101,36 +210,18 @@ class ChineseToFrenchDictionary:
         Returns a str object, with the correct pinyin
         """
         try:
-            new_pinyin = ""
-            last_span = 0
-            for particule in self.pinyin_re.finditer(pinyins):
-                pinyin_correct = particule.group().lower().replace("v", "\u00fc")
-                pinyin_correct = pinyin_correct.lower().replace("u:", "\u00fc")
-
-                vowels = self.vowels_re.search(pinyin_correct)
-                # Check which letter to put accent on
-                if (len(vowels.group()) == 1) or vowels.group()[0] in "aeo":
-                    pinyin_correct = pinyin_correct.replace(
-                        vowels.group()[0],
-                        self.pinyin_tone[vowels.group()[0]][int(pinyin_correct[-1])],
-                    )
-                else:
-                    pinyin_correct = pinyin_correct.replace(
-                        vowels.group()[1],
-                        self.pinyin_tone[vowels.group()[1]][int(pinyin_correct[-1])],
-                    )
-                new_pinyin += (
-                    pinyins[last_span : particule.span()[0]] + pinyin_correct[:-1]
-                )  # We do not take the last number
-                last_span = particule.span()[1]
-
-            if last_span != len(pinyins):
-                new_pinyin += pinyins[last_span:]
-            return new_pinyin
+            return self.pinyin_re.sub(
+                lambda particule: _accent_syllable(particule.group()), pinyins
+            )
         except AttributeError:  # Typically xx5, n2, m2
             return pinyins
 
 
+# Finds parenthesized indicators like '(助词)' in a hanzi.
+# The [^)] character class does not backtrack, unlike a lazy .*?
+_PAREN_RE = re.compile(r"\([^)]*\)")
+
+
 class HskHtmlParser(HTMLParser):  # pylint: disable=W0223
     """
     Class for reading HTML HSK data.
@@ -172,29 +263,71 @@ class HskHtmlParser(HTMLParser):  # pylint: disable=W0223
         Swiches the english definition of each word (from HTML) to its french definition (from .u8)
         Returns None
         """
-        for i in range(len(self.content["words"])):
-            word = self.content["words"][i]["hanziRaw"].strip()
-            sub_df = self.dictionary.df[self.dictionary.df["Simplified"] == word]
-
-            if len(sub_df) > 1:
-                sub_sub_df = sub_df[
-                    sub_df["Pinyin"]
-                    == self.content["words"][i]["pinyinToneSpace"].strip()
-                ]
-                if len(sub_sub_df) == 1:
-                    self.content["words"][i]["def"] = sub_sub_df["Translation"].iloc[0]
-                else:
-                    logger.warning(
-                        "Multiple translations for %s. Keeping the English translation.",
-                        word,
-                    )
-            elif len(sub_df) == 0:
+        # Bound method looked up once instead of once per word. The
+        # dictionary side is already stripped at build time, so only the
+        # HTML-side keys need a strip here
+        lookup = self.dictionary.by_simplified.get
+        for word_entry in self.content["words"]:
+            word = word_entry["hanziRaw"].strip()
+            entries = lookup(word)
+
+            if not entries:
                 logger.warning(
                     "%s has no French translation. Keeping the English translation.",
                     word,
                 )
+            elif len(entries) == 1:
+                word_entry["def"] = next(iter(entries.values()))
             else:
-                self.content["words"][i]["def"] = sub_df["Translation"].iloc[0]
+                # Polyphone: disambiguate with the pinyin of the HSK entry
+                translation = entries.get(word_entry["pinyinToneSpace"].strip())
+                if translation is not None:
+                    word_entry["def"] = translation
+                else:
+                    logger.warning(
+                        "Multiple translations for %s. Keeping the English translation.",
+                        word,
+                    )
+
+    def parse_file(self, html_file, chunk_size=65536):
+        """
+        Extracts and processes the HSK data of an HTML file.
+        Faster alternative to feeding the whole file to HTMLParser.feed,
+        which tokenizes the markup character by character in pure Python:
+        the file is read in chunks, the REACT_DATA payload is located with
+        a direct substring search and everything else is ignored, so peak
+        memory is bounded by the payload instead of the whole file.
+        Updates self.content
+
+        Positionnal arguments:
+        html_file (str) -- Path to the HSK .html file
+        Keyword arguments:
+        chunk_size (int) -- How many characters to read per chunk
+        Returns None
+        """
+        marker = "window.__REACT_DATA = "
+        with open(html_file, encoding="utf-8") as file:
+            start = -1
+            tail = ""
+            while chunk := file.read(chunk_size):
+                data = tail + chunk
+                start = data.find(marker)
+                if start != -1:
+                    payload_parts = [data[start + len(marker) :]]
+                    break
+                # Keeping an overlap in case the marker straddles two chunks
+                tail = data[-(len(marker) - 1) :]
+            if start == -1:
+                logger.warning("No REACT_DATA found in %s", html_file)
+                return
+            # The payload is a single line, closed by ';'
+            while ";\n" not in payload_parts[-1]:
+                chunk = file.read(chunk_size)
+                if not chunk:
+                    break
+                payload_parts.append(chunk)
+        payload = "".join(payload_parts)
+        self._process_react_payload(payload[: payload.index(";\n")])
 
     def handle_data(self, data):
         """
@@ -208,28 +341,49 @@ class HskHtmlParser(HTMLParser):  # pylint: disable=W0223
         data (str) --
         Returns None
         """
+        if self.content:
+            return  # The REACT_DATA payload was already processed
+        if len(data) < len("window.__REACT_DATA = "):
+            return  # Too short to contain the payload, e.g. most text nodes
         if "window.__REACT_DATA = " in data:
             content = data.split("window.__REACT_DATA = ")[1][
                 :-2
             ]  # removing the last ';'
+            self._process_react_payload(content)
+
+    def _process_react_payload(self, content):
+        """
+        Parses the REACT_DATA payload and fills self.content: grammar
+        indicators, classifiers and, if translate_to_french, the French
+        translations. Shared by handle_data and parse_file.
+
+        Positionnal arguments:
+        content (str) -- The payload, without the trailing ';'
+        Returns None
+        """
+        try:
+            # The React payload is plain JSON, which parses much faster
+            # than going through a full Python AST
+            self.content = json.loads(content)
+        except json.JSONDecodeError:
             self.content = ast.literal_eval(content)
-            self.check_grammar_indicators()
-            if "words" in self.content.keys():
-                for i in range(len(self.content["words"])):
-                    # Keeping the classifiers
-                    # for instance cl='; CL:宗[zōng] ,桩[zhuāng] ,起[qǐ]'
-                    word_def = self.content["words"][i]["def"]
-                    cl_str = next(self.cl_re.finditer(word_def), None)
-                    if cl_str:
-                        # Not considering the fist 5 characters "; CL:"
-                        self.content["words"][i]["CL"] = self.dictionary.format_pinyin(
-                            cl_str.group()[5:]
-                        ).replace(" ,", ", ")
-                        self.content["words"][i]["def"] = word_def[: cl_str.span()[0]]
-                    else:
-                        self.content["words"][i]["CL"] = None
-            if self.translate_to_french:
-                self.translate_content_to_french()
+        self.check_grammar_indicators()
+        if "words" in self.content.keys():
+            for i in range(len(self.content["words"])):
+                # Keeping the classifiers
+                # for instance cl='; CL:宗[zōng] ,桩[zhuāng] ,起[qǐ]'
+                word_def = self.content["words"][i]["def"]
+                cl_str = next(self.cl_re.finditer(word_def), None)
+                if cl_str:
+                    # Not considering the fist 5 characters "; CL:"
+                    self.content["words"][i]["CL"] = self.dictionary.format_pinyin(
+                        cl_str.group()[5:]
+                    ).replace(" ,", ", ")
+                    self.content["words"][i]["def"] = word_def[: cl_str.span()[0]]
+                else:
+                    self.content["words"][i]["CL"] = None
+        if self.translate_to_french:
+            self.translate_content_to_french()
 
     def check_grammar_indicators(self):
         """
@@ -265,148 +419,188 @@ class HskHtmlParser(HTMLParser):  # pylint: disable=W0223
 
         # Checking if there are other indicators like '(助词)' in
         # the data that are not already in grammar_indicator
-        parenthesis_regex = re.compile(r"\(.*?\)")
-        list_missing_indicator = []
+        missing_indicators = set()  # A set deduplicates as it goes
         for word_entry in self.content["words"]:
             if word_entry["hanzi"] != word_entry["hanziRaw"]:
-                parenthesis_words = parenthesis_regex.findall(word_entry["hanzi"])
-                if parenthesis_words:
-                    list_missing_indicator += [
-                        k for k in parenthesis_words if k not in self.grammar_indicator
-                    ]
-
-        list_missing_indicator = list(
-            set(list_missing_indicator)
-        )  # Removing duplicates
-        if len(list_missing_indicator) > 0:
-            logger.warning("Missing grammar indicators: %s", list_missing_indicator)
+                missing_indicators.update(_PAREN_RE.findall(word_entry["hanzi"]))
 
-    def create_word_xml_automatic(self, output_file):
+        # One set difference instead of a membership test per match
+        missing_indicators -= self.grammar_indicator.keys()
+        if missing_indicators:
+            logger.warning("Missing grammar indicators: %s", list(missing_indicators))
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _open_deck_stream(output_file, header):
         """
-        Create a AnkiApp Chinese deck with words from the HTML HSK file.
+        Opens output_file and streams a deck around its cards: the header
+        (deck and fields, with the deck and cards tags left open) is
+        written on entry, so that the caller can write each card as soon
+        as it is built, and the tags are closed on exit. Only one card is
+        kept in memory at a time instead of the full tree.
+        The file is opened in binary mode with a 1 MiB buffer: the cards
+        are encoded straight to UTF-8 bytes, skipping the TextIOWrapper
+        layer, and a whole deck usually fits in a single OS write.
+
         Positionnal arguments:
         output_file (str) -- Path to the output .xml file
-        Returns None
+        header (str) -- The serialized deck and fields opening the file
+        Yields the opened binary file object
         """
-        deck = ET.Element(
-            "deck",
-            attrib={
-                "name": (
-                    f'HSK {self.content["hskLevel"]} '
-                    f'{self.metadata[self.metadata_key]["Word List"]}'
-                )
-            },
-        )
+        with open(output_file, "wb", buffering=1 << 20) as file:
+            file.write(header.encode("utf-8"))
+            yield file
+            file.write(b"</cards></deck>")
 
-        fields = ET.SubElement(deck, "fields")
-        ET.SubElement(
-            fields,
-            "chinese",
-            attrib={
-                "name": self.metadata[self.metadata_key]["Chinese"],
-                "sides": "10",
-                "lang": "zh-CN",
-                "pinyinMode": "back",
-            },
-        )
-        ET.SubElement(
-            fields,
-            "text",
-            attrib={
-                "name": self.metadata[self.metadata_key]["Translation"],
-                "sides": "01",
-                "lang": self.metadata[self.metadata_key]["lang"],
-            },
-        )
+    def _deck_templates(self, name_key, pinyin_key):
+        """
+        Builds the serialized deck header and the per-card format template
+        of a deck. With pinyin_key=None the deck relies on AnkiApp's
+        automatic pinyin detection: cards get a chinese and a translated
+        text field. With a pinyin_key, cards get Front/Back text fields
+        plus a rich-text Pinyin field filled from the entry's manually
+        written pinyin.
 
-        cards = ET.SubElement(deck, "cards")
+        Positionnal arguments:
+        name_key (str) -- Metadata key of the deck name ("Word List" or "Sentences")
+        pinyin_key (str) -- Entry key holding the manually written pinyin, or None
+        Returns a (header, card_template) tuple of str
+        """
+        metadata = self.metadata[self.metadata_key]
+        deck_name = f'HSK {self.content["hskLevel"]} {metadata[name_key]}'
+        if pinyin_key is None:
+            header = (
+                f'<deck name="{deck_name}"><fields>'
+                f'<chinese name="{metadata["Chinese"]}" sides="10"'
+                ' lang="zh-CN" pinyinMode="back" />'
+                f'<text name="{metadata["Translation"]}" sides="01"'
+                f' lang="{metadata["lang"]}" />'
+                "</fields><cards>"
+            )
+            card_template = (
+                f'<card><chinese name="{metadata["Chinese"]}">{{}}</chinese>'
+                f'<text name="{metadata["Translation"]}">{{}}</text></card>'
+            )
+        else:
+            header = (
+                f'<deck name="{deck_name}"><fields>'
+                '<text name="Front" sides="11" lang="zh-CN" />'  # Visible on both sides
+                '<text name="Back" sides="01" lang="zh-CN" />'
+                '<rich-text name="Pinyin" sides="01" />'
+                "</fields><cards>"
+            )
+            card_template = (
+                '<card><text name="Front">{}</text><text name="Back">{}</text>'
+                '<rich-text name="Pinyin"><b>{}</b></rich-text></card>'
+            )
+        return header, card_template
 
-        for word_entry in self.content["words"]:
+    def _flatten_entries(self, entries, pinyin_key):
+        """
+        Flattens each entry to a (hanzi, definition, pinyin) tuple, with
+        grammar indicators already replaced, so that the card loop of
+        _write_deck is plain tuple unpacking without per-card dict
+        lookups.
 
+        Positionnal arguments:
+        entries (list) -- The word or sentence entries of self.content
+        pinyin_key (str) -- Entry key holding the manually written pinyin, or None
+        Returns a list of (str, str, str or None) tuples
+        """
+        # The hot attributes are bound to locals before the loop. A single
+        # regex matches every grammar indicator, so that replacing them
+        # costs one scan of the hanzi instead of one scan per indicator
+        grammar_indicator = self.grammar_indicator
+        grammar_sub = re.compile(
+            "|".join(re.escape(key) for key in grammar_indicator)
+        ).sub
+        format_pinyin = self.dictionary.format_pinyin
+
+        def replace_indicator(match):
+            return grammar_indicator[match.group(0)]
+
+        rows = []
+        for word_entry in entries:
             hanzi = word_entry["hanzi"]
             definition = word_entry["def"]
-            if word_entry["CL"]:
+            if word_entry.get("CL"):
                 definition += "; CL: " + word_entry["CL"]
 
-            if hanzi != word_entry["hanziRaw"]:
+            if hanzi != word_entry.get("hanziRaw", hanzi):
                 # Replacing chinese grammar indicators
-                for key, value in self.grammar_indicator.items():
-                    hanzi = hanzi.replace(key, value)
-
-            card = ET.SubElement(cards, "card")
-            ET.SubElement(
-                card,
-                "chinese",
-                attrib={"name": self.metadata[self.metadata_key]["Chinese"]},
-            ).text = hanzi
-            ET.SubElement(
-                card,
-                "text",
-                attrib={"name": self.metadata[self.metadata_key]["Translation"]},
-            ).text = definition
-
-        deck_tree = ET.ElementTree(deck)
-        deck_tree.write(output_file, encoding="unicode")
+                hanzi = grammar_sub(replace_indicator, hanzi)
 
-    def create_sentence_xml_automatic(self, output_file):
+            # Reomving "v4" and other bad pinyins
+            pinyin_accent = (
+                format_pinyin(word_entry[pinyin_key]) if pinyin_key else None
+            )
+            rows.append((hanzi, definition, pinyin_accent))
+        return rows
+
+    def _write_deck(
+        self, output_file, name_key, entries, pinyin_key=None, two_cards=False
+    ):
         """
-        Create a AnkiApp Chinese deck with sentences from the HTML HSK file.
+        Streams an AnkiApp deck with one card (or two with two_cards=True)
+        per entry to output_file. Common backend of the four
+        create_*_xml* methods. The deck layout is picked by
+        _deck_templates from pinyin_key.
+
         Positionnal arguments:
         output_file (str) -- Path to the output .xml file
+        name_key (str) -- Metadata key of the deck name ("Word List" or "Sentences")
+        entries (list) -- The word or sentence entries of self.content
+        Keyword arguments:
+        pinyin_key (str) -- Entry key holding the manually written pinyin
+        two_cards (bool) -- Whether to also create a reversed card per entry
         Returns None
         """
-        deck = ET.Element(
-            "deck",
-            attrib={
-                "name": (
-                    f'HSK {self.content["hskLevel"]} '
-                    f'{self.metadata[self.metadata_key]["Sentences"]}'
-                )
-            },
-        )
-
-        fields = ET.SubElement(deck, "fields")
-        ET.SubElement(
-            fields,
-            "chinese",
-            attrib={
-                "name": self.metadata[self.metadata_key]["Chinese"],
-                "sides": "10",
-                "lang": "zh-CN",
-                "pinyinMode": "back",
-            },
-        )
-        ET.SubElement(
-            fields,
-            "text",
-            attrib={
-                "name": self.metadata[self.metadata_key]["Translation"],
-                "sides": "01",
-                "lang": self.metadata[self.metadata_key]["lang"],
-            },
-        )
-
-        cards = ET.SubElement(deck, "cards")
-
-        for word_entry in self.content["localizedSentences"]:
+        header, card_template = self._deck_templates(name_key, pinyin_key)
+        rows = self._flatten_entries(entries, pinyin_key)
+
+        with self._open_deck_stream(output_file, header) as file:
+            write = file.write
+            if pinyin_key is None:
+                for hanzi, definition, _ in rows:
+                    write(
+                        card_template.format(escape(hanzi), escape(definition)).encode(
+                            "utf-8"
+                        )
+                    )
+            else:
+                for hanzi, definition, pinyin_accent in rows:
+                    hanzi = escape(hanzi)
+                    definition = escape(definition)
+                    pinyin_accent = escape(pinyin_accent)
+                    write(
+                        card_template.format(hanzi, definition, pinyin_accent).encode(
+                            "utf-8"
+                        )
+                    )
+                    if two_cards:
+                        write(
+                            card_template.format(
+                                definition, hanzi, pinyin_accent
+                            ).encode("utf-8")
+                        )
 
-            hanzi = word_entry["hanzi"]
-            definition = word_entry["def"]
+    def create_word_xml_automatic(self, output_file):
+        """
+        Create a AnkiApp Chinese deck with words from the HTML HSK file.
+        Positionnal arguments:
+        output_file (str) -- Path to the output .xml file
+        Returns None
+        """
+        self._write_deck(output_file, "Word List", self.content["words"])
 
-            card = ET.SubElement(cards, "card")
-            ET.SubElement(
-                card,
-                "chinese",
-                attrib={"name": self.metadata[self.metadata_key]["Chinese"]},
-            ).text = hanzi
-            ET.SubElement(
-                card,
-                "text",
-                attrib={"name": self.metadata[self.metadata_key]["Translation"]},
-            ).text = definition
-
-        deck_tree = ET.ElementTree(deck)
-        deck_tree.write(output_file, encoding="unicode")
+    def create_sentence_xml_automatic(self, output_file):
+        """
+        Create a AnkiApp Chinese deck with sentences from the HTML HSK file.
+        Positionnal arguments:
+        output_file (str) -- Path to the output .xml file
+        Returns None
+        """
+        self._write_deck(output_file, "Sentences", self.content["localizedSentences"])
 
     def create_word_xml(self, output_file):
         """
@@ -425,57 +619,14 @@ class HskHtmlParser(HTMLParser):  # pylint: disable=W0223
         output_file (str) -- Path to the output .xml file
         Returns None
         """
-        deck = ET.Element(
-            "deck",
-            attrib={
-                "name": (
-                    f'HSK {self.content["hskLevel"]} '
-                    f'{self.metadata[self.metadata_key]["Word List"]}'
-                )
-            },
+        self._write_deck(
+            output_file,
+            "Word List",
+            self.content["words"],
+            pinyin_key="pinyinToneSpace",
+            two_cards=True,
         )
 
-        fields = ET.SubElement(deck, "fields")
-        ET.SubElement(
-            fields, "text", attrib={"name": "Front", "sides": "11", "lang": "zh-CN"}
-        )  # Visible on both sides
-        ET.SubElement(
-            fields, "text", attrib={"name": "Back", "sides": "01", "lang": "zh-CN"}
-        )
-        ET.SubElement(fields, "rich-text", attrib={"name": "Pinyin", "sides": "01"})
-
-        cards = ET.SubElement(deck, "cards")
-
-        for word_entry in self.content["words"]:
-
-            hanzi = word_entry["hanzi"]
-            definition = word_entry["def"]
-            if word_entry["CL"]:
-                definition += "; CL: " + word_entry["CL"]
-
-            # Reomving "v4" and other bad pinyins
-            pinyin_accent = self.dictionary.format_pinyin(word_entry["pinyinToneSpace"])
-
-            if hanzi != word_entry["hanziRaw"]:
-                # Replacing chinese grammar indicators
-                for key, value in self.grammar_indicator.items():
-                    hanzi = hanzi.replace(key, value)
-
-            card = ET.SubElement(cards, "card")
-            ET.SubElement(card, "text", attrib={"name": "Front"}).text = hanzi
-            ET.SubElement(card, "text", attrib={"name": "Back"}).text = definition
-            pinyin_elem = ET.SubElement(card, "rich-text", attrib={"name": "Pinyin"})
-            ET.SubElement(pinyin_elem, "b").text = pinyin_accent
-
-            card = ET.SubElement(cards, "card")
-            ET.SubElement(card, "text", attrib={"name": "Front"}).text = definition
-            ET.SubElement(card, "text", attrib={"name": "Back"}).text = hanzi
-            pinyin_elem = ET.SubElement(card, "rich-text", attrib={"name": "Pinyin"})
-            ET.SubElement(pinyin_elem, "b").text = pinyin_accent
-
-        deck_tree = ET.ElementTree(deck)
-        deck_tree.write(output_file, encoding="unicode")
-
     def create_sentence_xml(self, output_file):
         """
         Create a AnkiApp text deck with sentences from the HTML HSK file.
@@ -490,44 +641,13 @@ class HskHtmlParser(HTMLParser):  # pylint: disable=W0223
         output_file (str) -- Path to the output .xml file
         Returns None
         """
-        deck = ET.Element(
-            "deck",
-            attrib={
-                "name": (
-                    f'HSK {self.content["hskLevel"]} '
-                    f'{self.metadata[self.metadata_key]["Sentences"]}'
-                )
-            },
+        self._write_deck(
+            output_file,
+            "Sentences",
+            self.content["localizedSentences"],
+            pinyin_key="pinyinTone",
         )
 
-        fields = ET.SubElement(deck, "fields")
-        ET.SubElement(
-            fields, "text", attrib={"name": "Front", "sides": "11", "lang": "zh-CN"}
-        )  # Visible on both sides
-        ET.SubElement(
-            fields, "text", attrib={"name": "Back", "sides": "01", "lang": "zh-CN"}
-        )
-        ET.SubElement(fields, "rich-text", attrib={"name": "Pinyin", "sides": "01"})
-
-        cards = ET.SubElement(deck, "cards")
-
-        for word_entry in self.content["localizedSentences"]:
-
-            hanzi = word_entry["hanzi"]
-            definition = word_entry["def"]
-
-            # Reomving "v4" and other bad pinyins
-            pinyin_accent = self.dictionary.format_pinyin(word_entry["pinyinTone"])
-
-            card = ET.SubElement(cards, "card")
-            ET.SubElement(card, "text", attrib={"name": "Front"}).text = hanzi
-            ET.SubElement(card, "text", attrib={"name": "Back"}).text = definition
-            pinyin_elem = ET.SubElement(card, "rich-text", attrib={"name": "Pinyin"})
-            ET.SubElement(pinyin_elem, "b").text = pinyin_accent
-
-        deck_tree = ET.ElementTree(deck)
-        deck_tree.write(output_file, encoding="unicode")
-
     def create_ankiweb_txt_for_words(self, output_file=""):
         """
         Create a simple AnkiWeb text file with words from the HTML HSK file.
@@ -541,13 +661,24 @@ class HskHtmlParser(HTMLParser):  # pylint: disable=W0223
         output_file (str) -- Path to the output .txt file
         Returns None
         """
+        # Hot attributes bound once before the loop. re.compile caches the
+        # pattern internally, so rebuilding it here costs a dict probe
+        grammar_indicator = self.grammar_indicator
+        grammar_sub = re.compile(
+            "|".join(re.escape(key) for key in grammar_indicator)
+        ).sub
+
+        def replace_indicator(match):
+            return grammar_indicator[match.group(0)]
+
         txt_content = ""
 
         for word_entry in self.content["words"]:
             if word_entry["hanzi"] != word_entry["hanziRaw"]:
                 # Replacing chinese grammar indicators
-                for key, value in self.grammar_indicator.items():
-                    word_entry["hanzi"] = word_entry["hanzi"].replace(key, value)
+                word_entry["hanzi"] = grammar_sub(
+                    replace_indicator, word_entry["hanzi"]
+                )
             txt_content += (
                 f'"{word_entry["def"]}";"{word_entry["hanzi"]}";'
                 f'"{word_entry["pinyinToneSpace"]}";'